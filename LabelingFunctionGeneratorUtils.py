@@ -1,7 +1,23 @@
 from snorkel.labeling import labeling_function
+import spacy
+from spacy.tokens import Doc, DocBin
+from spacy.strings import get_string_id
 from textblob import TextBlob
-from thefuzz import fuzz
+from textblob.en import sentiment as TextBlobLexicon
+from collections import namedtuple
+from rapidfuzz import fuzz, process, utils
+from flashtext import KeywordProcessor
+from joblib import Parallel, delayed, effective_n_jobs
+import numpy as np
 import re
+import string
+
+try:
+    from numba import njit
+except ImportError:
+    # the lexicon sentiment kernel is plain NumPy and still runs without numba
+    def njit(function):
+        return function
 
 '''
 
@@ -52,16 +68,399 @@ import re
     - TextBlob: 
       - `subjectivity`->[0.0, 1.0] where 0 is purely objective and 1 is purely subjective
       - `polarity`->[-1.0, +1.0] where -1 is negative and +1 is positive
+    - SentimentModel (optional): `TextBlob` (default) or `Lexicon`, a faster
+      mean of TextBlob's lexicon scores over the spaCy tokens
       
 '''
 
 
+# sentiment of a doc, computed once per model and shared by every sentiment LF
+Doc.set_extension('tb_sentiment', default = None, force = True)
+Doc.set_extension('lexicon_sentiment', default = None, force = True)
+
+# entities of a doc grouped by NER label ID, shared by every NER LF and rebuilt when doc.ents changes
+Doc.set_extension('ents_by_label', default = None, force = True)
+
+# lowercased text of a doc, computed once and shared by every keyword LF
+Doc.set_extension('text_lower', default = None, force = True)
+
+Sentiment = namedtuple('Sentiment', ['polarity', 'subjectivity'])
+
+
+def _TextLower(InputSpacyDoc):
+    '''
+    Returns InputSpacyDoc.text.lower(), computed on first use
+    and cached on the doc.
+    '''
+    
+    TextLower = InputSpacyDoc._.text_lower
+    if TextLower is None:
+        TextLower = InputSpacyDoc._.text_lower = InputSpacyDoc.text.lower()
+    return TextLower
+
+
+def _EntsByLabel(InputSpacyDoc):
+    '''
+    Returns {NER label ID: [entity texts]} for a doc, built in a single pass
+    over doc.ents and cached on the doc together with the (start, end,
+    label) of the entities it was built from, so it is rebuilt whenever
+    doc.ents changes (e.g. NER run after the doc was first labeled).
+    Texts rather than spans are stored so that docs stay picklable
+    (see ApplyLFsParallel).
+    
+    Labels are keyed by spaCy's integer label ID (Span.label, the same
+    value as get_string_id(label_)), so lookups never build label strings.
+    '''
+    
+    EntsKey = tuple((each_ent.start, each_ent.end, each_ent.label) for each_ent in InputSpacyDoc.ents)
+    Cached = InputSpacyDoc._.ents_by_label
+    if Cached is not None and Cached[0] == EntsKey:
+        return Cached[1]
+    EntsByLabel = {}
+    for each_ent in InputSpacyDoc.ents:
+        EntsByLabel.setdefault(each_ent.label, []).append(each_ent.text)
+    InputSpacyDoc._.ents_by_label = (EntsKey, EntsByLabel)
+    return EntsByLabel
+
+
+# TextBlob's lexicon as NumPy arrays sorted by spaCy string ID, built on first use
+_LexiconArrays = None
+
+
+def _GetLexiconArrays():
+    '''
+    Returns (IDs, polarity, subjectivity) arrays for the single-word
+    lowercase entries of TextBlob's sentiment lexicon, sorted by the
+    spaCy string ID of the word (the value of the LOWER token attribute).
+    '''
+    
+    global _LexiconArrays
+    if _LexiconArrays is None:
+        Entries = sorted((get_string_id(each_word), each_scores[None][0], each_scores[None][1])
+                         for each_word, each_scores in TextBlobLexicon.items()
+                         if ' ' not in each_word and each_word == each_word.lower())
+        _LexiconArrays = (np.array([each_entry[0] for each_entry in Entries], dtype = np.uint64),
+                          np.array([each_entry[1] for each_entry in Entries], dtype = np.float64),
+                          np.array([each_entry[2] for each_entry in Entries], dtype = np.float64))
+    return _LexiconArrays
+
+
+@njit
+def _MeanLexiconSentiment(TokenIDs, LexiconIDs, LexiconPolarity, LexiconSubjectivity):
+    Index = np.minimum(np.searchsorted(LexiconIDs, TokenIDs), LexiconIDs.shape[0] - 1)
+    Index = Index[LexiconIDs[Index] == TokenIDs]
+    if Index.shape[0] == 0:
+        return 0.0, 0.0
+    return LexiconPolarity[Index].mean(), LexiconSubjectivity[Index].mean()
+
+
+def _LexiconSentiment(InputSpacyDoc):
+    '''
+    Approximates TextBlob sentiment without running TextBlob: polarity and
+    subjectivity are the mean of the TextBlob lexicon scores of the
+    lowercased spaCy tokens found in the lexicon (0.0 if none are).
+    
+    Unlike TextBlob, negations, intensifiers and multi-word lexicon
+    entries are not taken into account.
+    
+    Tokens are looked up by their LOWER string IDs in sorted NumPy arrays,
+    in a kernel compiled with numba when it is installed.
+    '''
+    
+    LexiconIDs, LexiconPolarity, LexiconSubjectivity = _GetLexiconArrays()
+    TokenIDs = InputSpacyDoc.to_array('LOWER').astype(np.uint64)
+    polarity, subjectivity = _MeanLexiconSentiment(TokenIDs, LexiconIDs, LexiconPolarity, LexiconSubjectivity)
+    return Sentiment(float(polarity), float(subjectivity))
+
+
+def _DocSentiment(InputSpacyDoc, SentimentModel):
+    '''
+    Returns the (polarity, subjectivity) of a doc for the given
+    SentimentModel ('TextBlob' or 'Lexicon'), cached on the doc.
+    '''
+    
+    if SentimentModel == 'TextBlob':
+        scores = InputSpacyDoc._.tb_sentiment
+        if scores is None:
+            # stored as the module-level Sentiment, TextBlob's own namedtuple can't be pickled
+            scores = Sentiment(*TextBlob(InputSpacyDoc.text).sentiment)
+            InputSpacyDoc._.tb_sentiment = scores
+    elif SentimentModel == 'Lexicon':
+        scores = InputSpacyDoc._.lexicon_sentiment
+        if scores is None:
+            scores = _LexiconSentiment(InputSpacyDoc)
+            InputSpacyDoc._.lexicon_sentiment = scores
+    else:
+        raise ValueError('Unknown SentimentModel: ' + str(SentimentModel))
+    if not isinstance(scores, Sentiment):
+        # a cached value that came back from DocBin's user_data as a plain list
+        scores = Sentiment(*scores)
+    return scores
+
+
+# keyword lists up to this long are matched with str.find instead of a regex
+_FindMaxKeywords = 3
+
+# keyword lists longer than this are matched with a flashtext trie instead of a regex
+_FlashTextMinKeywords = 64
+
+# characters that continue a word; a keyword match must not touch one on either side
+_WordChars = frozenset(string.ascii_lowercase + string.digits)
+
+# compiled keyword matchers keyed by their (lowercased) set of keywords,
+# so LFs built from the same keyword list share one matcher
+_KeywordMatcherCache = {}
+
+
+def _CompileKeywordMatcher(ListOfKeywords):
+    '''
+    Compiles a list of keywords into a single matcher that finds any of
+    the keywords, ignoring case, as a whole word in a doc's text, and
+    returns it as a function KeywordFound(InputSpacyDoc) -> bool.
+    
+    A keyword is a whole word when it is not preceded or followed by
+    [a-z0-9]; the start and end of the text also count as boundaries.
+    
+    Lists of up to _FindMaxKeywords keywords are searched with str.find,
+    which avoids starting the regex engine for the common one-keyword LF.
+    Longer lists become one regex alternation, longest keywords first.
+    Lists longer than _FlashTextMinKeywords become a flashtext trie,
+    whose cost does not grow with the number of keywords.
+    
+    Every matcher behaves as if searching the lowercased text cached on
+    the doc (_TextLower). The regex searches pure-ASCII text as is, with
+    ASCII-only case folding, which gives the same result without the copy.
+    
+    An empty list compiles to a matcher that never matches.
+    
+    Matchers are cached per set of keywords in _KeywordMatcherCache.
+    
+    Params:
+    ListOfKeywords:[str]
+    '''
+    
+    KeywordSet = frozenset(each_keyword.lower() for each_keyword in ListOfKeywords)
+    KeywordFound = _KeywordMatcherCache.get(KeywordSet)
+    if KeywordFound is None:
+        KeywordFound = _KeywordMatcherCache[KeywordSet] = _BuildKeywordMatcher(KeywordSet)
+    return KeywordFound
+
+
+def _BuildKeywordMatcher(KeywordSet):
+    '''
+    Builds the matcher described in _CompileKeywordMatcher
+    from a set of lowercased keywords.
+    '''
+    
+    Keywords = sorted(KeywordSet, key = len, reverse = True)
+    if len(Keywords) <= _FindMaxKeywords:
+        return _FindKeywordMatcher(Keywords)
+    if len(Keywords) > _FlashTextMinKeywords:
+        return _FlashTextKeywordMatcher(Keywords)
+    return _RegexKeywordMatcher(Keywords)
+
+
+def _FindKeywordMatcher(Keywords):
+    '''
+    Keyword matcher using str.find on the lowercased text,
+    checking the characters around each hit against _WordChars.
+    '''
+    
+    def KeywordFound(InputSpacyDoc):
+        text = _TextLower(InputSpacyDoc)
+        for each_keyword in Keywords:
+            start = text.find(each_keyword)
+            while start >= 0:
+                end = start + len(each_keyword)
+                if (start == 0 or text[start - 1] not in _WordChars) \
+                and (end == len(text) or text[end] not in _WordChars):
+                    return True
+                start = text.find(each_keyword, start + 1)
+        return False
+    return KeywordFound
+
+
+def _FlashTextKeywordMatcher(Keywords):
+    '''
+    Keyword matcher using a flashtext trie on the lowercased text,
+    with _WordChars as the trie's word characters.
+    '''
+    
+    # keywords are lowercased by _CompileKeywordMatcher, text by _TextLower
+    KeywordTrie = KeywordProcessor(case_sensitive = True)
+    KeywordTrie.non_word_boundaries = set(_WordChars)
+    KeywordTrie.add_keywords_from_list(Keywords)
+    def KeywordFound(InputSpacyDoc):
+        return bool(KeywordTrie.extract_keywords(_TextLower(InputSpacyDoc)))
+    return KeywordFound
+
+
+def _RegexKeywordMatcher(Keywords):
+    '''
+    Keyword matcher using one regex alternation, longest keywords first
+    (Keywords is expected sorted that way).
+    '''
+    
+    # with re.ASCII, IGNORECASE only folds A-Z, so on ASCII text searching the
+    # original equals searching text.lower(). Unicode IGNORECASE would also let
+    # [a-z] match e.g. 'ı', 'ſ' or the Kelvin sign, unlike the other matchers,
+    # so non-ASCII text is searched lowercased instead
+    KeywordPattern = re.compile('(?<![a-z0-9])(' + '|'.join(map(re.escape, Keywords)) + ')(?![a-z0-9])',
+                                re.IGNORECASE | re.ASCII)
+    def KeywordFound(InputSpacyDoc):
+        text = InputSpacyDoc.text
+        if not text.isascii():
+            text = _TextLower(InputSpacyDoc)
+        return KeywordPattern.search(text) is not None
+    return KeywordFound
+
+
+# thefuzz's force_ascii drops the code points 128-255 (e.g. 'á', 'é') before processing
+_Latin1Deletion = {each_code: None for each_code in range(128, 256)}
+
+
+def _TokenSortProcess(text):
+    '''
+    Normalizes text the way this module used to before calling thefuzz's
+    fuzz.token_sort_ratio (lower(), then force_ascii, default_process and
+    tokens sorted and joined by single spaces), so that rapidfuzz's
+    fuzz.ratio on two processed strings equals the unrounded thefuzz
+    token_sort_ratio on the lowercased originals.
+    '''
+    
+    return ' '.join(sorted(utils.default_process(text.lower().translate(_Latin1Deletion)).split()))
+
+
+def _SpecializeFunction(Source, FunctionName, Namespace, **Constants):
+    '''
+    Builds the function FunctionName from a source template, with the
+    Constants written into the code as literals ({name} in Source is
+    replaced by repr(value)) instead of being read from closure cells.
+    Namespace holds the globals the generated function may use.
+    '''
+    
+    # inf and nan are defined so that repr() of infinite or NaN floats is valid code
+    Namespace = dict(Namespace, __name__ = __name__, inf = float('inf'), nan = float('nan'))
+    exec(Source.format(**{each_name: repr(each_value) for each_name, each_value in Constants.items()}), Namespace)
+    return Namespace[FunctionName]
+
+
+# per-doc LF bodies specialized by _SpecializeFunction
+_SentimentCheckerSource = '''
+def TextBlobSentimentChecker(InputSpacyDoc):
+    scores = _DocSentiment(InputSpacyDoc, {SentimentModel})
+    if {PolarityLower} < scores.polarity < {PolarityUpper} \\
+    and {SubjectivityLower} < scores.subjectivity < {SubjectivityUpper}:
+        return {ReturnLabel}
+    return {ABSTAIN}
+'''
+
+_KeywordExactMatchSource = '''
+def CheckForKeywordExactMatch(InputSpacyDoc):
+    if KeywordFound(InputSpacyDoc):
+        return {ReturnLabel}
+    return {ABSTAIN}
+'''
+
+
+# token/doc attributes that make up doc.ents
+_EntAttributes = frozenset(['doc.ents', 'token.ent_iob', 'token.ent_type'])
+
+
+def _PipesForLFs(nlp):
+    '''
+    Returns the names of the pipeline components needed to reproduce
+    doc.ents, in pipeline order:
+    
+    - components assigning doc.ents (ner, entity_ruler, a span_ruler
+      with annotate_ents, ...)
+    - components that declare no assigns at all (e.g. attribute_ruler or
+      custom components), since they may affect the entities
+    - components assigning attributes a kept component requires
+    - tok2vec / transformer components a kept component listens to
+    '''
+    
+    Needed = set()
+    for each_name, each_pipe in nlp.pipeline:
+        Assigns = set(nlp.get_pipe_meta(each_name).assigns)
+        if not Assigns or Assigns & _EntAttributes or getattr(each_pipe, 'annotate_ents', False):
+            Needed.add(each_name)
+    
+    Changed = True
+    while Changed:
+        Changed = False
+        Required = set()
+        for each_name in Needed:
+            Required.update(nlp.get_pipe_meta(each_name).requires)
+        for each_name, each_pipe in nlp.pipeline:
+            if each_name in Needed:
+                continue
+            if Required & set(nlp.get_pipe_meta(each_name).assigns) \
+            or Needed & set(getattr(each_pipe, 'listening_components', ())):
+                Needed.add(each_name)
+                Changed = True
+    return [each_name for each_name in nlp.pipe_names if each_name in Needed]
+
+
+def MakeDocForLFs(nlp, text, KeywordsOnly = False):
+    '''
+    Runs only the parts of a spaCy pipeline the LFs in this module need.
+    
+    The NER LFs (NERTagPresence, NERTagAbsence, NamedEntityFuzzyMatch)
+    read InputSpacyDoc.ents, the sentiment LFs read InputSpacyDoc.text
+    (or its tokens) and the keyword LFs read InputSpacyDoc.text only.
+    Components that cannot change doc.ents (parser, lemmatizer, tagger,
+    textcat etc., see _PipesForLFs) are disabled while the doc is created.
+    
+    Params:
+    nlp: spacy Language
+    text:str
+    KeywordsOnly:bool -> if True, only tokenize (nlp.make_doc); enough
+    for the keyword and sentiment LFs but leaves doc.ents empty
+    '''
+    
+    return MakeDocsForLFs(nlp, [text], KeywordsOnly = KeywordsOnly)[0]
+
+
+def MakeDocsForLFs(nlp, texts, KeywordsOnly = False, batch_size = None):
+    '''
+    Same as MakeDocForLFs for many texts, batched through nlp.pipe.
+    Returns a list of docs.
+    
+    Params:
+    nlp: spacy Language
+    texts:[str]
+    KeywordsOnly:bool -> if True, only tokenize (nlp.make_doc)
+    batch_size:int -> passed to nlp.pipe
+    '''
+    
+    if KeywordsOnly:
+        return [nlp.make_doc(each_text) for each_text in texts]
+    with nlp.select_pipes(enable = _PipesForLFs(nlp)):
+        return list(nlp.pipe(texts, batch_size = batch_size))
+
+
+def _CheckReturnLabel(ReturnLabel):
+    '''
+    Returns ReturnLabel if it fits the int8 label matrix built by ApplyLFs
+    (-1 to 127, -1 being ABSTAIN), so a bad label fails when the LF is
+    built rather than wrapping around silently when it is applied.
+    '''
+    
+    if isinstance(ReturnLabel, bool) or not isinstance(ReturnLabel, (int, np.integer)) \
+            or not -1 <= ReturnLabel <= 127:
+        raise ValueError('ReturnLabel must be an int between -1 and 127, got %r' % (ReturnLabel,))
+    return ReturnLabel
+
+
 def NERTagPresence(**kwargs):
     '''
     Detects if a specific SpaCy NER tagged token is present in the transcript
     and returns LABEL
     if no tag : ABSTAIN
     
+    Only InputSpacyDoc.ents is used (see MakeDocForLFs)
+    
     Params:
     LabelingFunctionName:str
     NERTag:str
@@ -70,16 +469,21 @@ def NERTagPresence(**kwargs):
 
     LabelingFunctionName = kwargs['LabelingFunctionName']
     NERTag = kwargs['NERTag']
-    ReturnLabel = kwargs['ReturnLabel']
+    ReturnLabel = _CheckReturnLabel(kwargs['ReturnLabel'])
     ABSTAIN = -1
+    NERTagID = get_string_id(NERTag)
     @labeling_function(name = LabelingFunctionName)
     def CheckNERTagPresence(InputSpacyDoc):
-        for each_ent in InputSpacyDoc.ents:
-            if each_ent.label_ == NERTag:
-                return ReturnLabel
+        if NERTagID in _EntsByLabel(InputSpacyDoc):
+            return ReturnLabel
         return ABSTAIN
     
+    def BatchNERTagPresence(InputSpacyDocs):
+        return np.array([ReturnLabel if NERTagID in _EntsByLabel(each_doc) else ABSTAIN
+                         for each_doc in InputSpacyDocs], dtype = np.int8)
+    
     CheckNERTagPresence.__name__ = LabelingFunctionName
+    CheckNERTagPresence.vector_apply = CheckNERTagPresence.batch = BatchNERTagPresence
     
     return CheckNERTagPresence
     
@@ -89,6 +493,8 @@ def NERTagAbsence(**kwargs):
     and returns LABEL if the tag is absent
     if tag is present, then: ABSTAIN
     
+    Only InputSpacyDoc.ents is used (see MakeDocForLFs)
+    
     Params:
     LabelingFunctionName:str
     NERTag:str
@@ -97,16 +503,21 @@ def NERTagAbsence(**kwargs):
 
     LabelingFunctionName = kwargs['LabelingFunctionName']
     NERTag = kwargs['NERTag']
-    ReturnLabel = kwargs['ReturnLabel']
+    ReturnLabel = _CheckReturnLabel(kwargs['ReturnLabel'])
     ABSTAIN = -1
+    NERTagID = get_string_id(NERTag)
     @labeling_function(name = LabelingFunctionName)
     def CheckNERTagAbsence(InputSpacyDoc):
-        for each_ent in InputSpacyDoc.ents:
-            if each_ent.label_ == NERTag:
-                return ABSTAIN
+        if NERTagID in _EntsByLabel(InputSpacyDoc):
+            return ABSTAIN
         return ReturnLabel
     
+    def BatchNERTagAbsence(InputSpacyDocs):
+        return np.array([ABSTAIN if NERTagID in _EntsByLabel(each_doc) else ReturnLabel
+                         for each_doc in InputSpacyDocs], dtype = np.int8)
+    
     CheckNERTagAbsence.__name__ = LabelingFunctionName
+    CheckNERTagAbsence.vector_apply = CheckNERTagAbsence.batch = BatchNERTagAbsence
     
     return CheckNERTagAbsence
 
@@ -122,6 +533,9 @@ def SentimentChecker(**kwargs):
     
     Else ABSTAIN
     
+    Only InputSpacyDoc.text and its tokens are used, so a tokenizer-only
+    doc is enough (see MakeDocForLFs)
+    
     subjectivity->[0.0, 1.0] where 0 is purely objective and 1 is purely subjective
     
     SubjectivityLower: (float) -> lower threshold for subjectivity
@@ -131,6 +545,12 @@ def SentimentChecker(**kwargs):
 
     PolarityLower: (float) -> lower threshold for polarity
     PolarityUpper: (float) -> upper threshold for polarity
+    (thresholds are compared as Python floats, so NumPy scalars and
+    +-inf work the same as plain numbers)
+    
+    SentimentModel: (str, optional) -> 'TextBlob' (default) or 'Lexicon';
+    'Lexicon' averages TextBlob's lexicon scores over the spaCy tokens,
+    which is much faster but ignores negations and intensifiers
     
     LabelingFunctionName:str
     ReturnLabel:int (class label)
@@ -147,21 +567,31 @@ def SentimentChecker(**kwargs):
     #polarity->[-1.0, +1.0] where -1 is negative and +1 is positive
     PolarityLower = kwargs['PolarityLower']
     PolarityUpper = kwargs['PolarityUpper']
-    ReturnLabel = kwargs['ReturnLabel']
+    ReturnLabel = _CheckReturnLabel(kwargs['ReturnLabel'])
+    SentimentModel = kwargs.get('SentimentModel', 'TextBlob')
+    if SentimentModel not in ('TextBlob', 'Lexicon'):
+        raise ValueError('Unknown SentimentModel: ' + str(SentimentModel))
     ABSTAIN = -1
-    @labeling_function(name = LabelingFunctionName)
-    def TextBlobSentimentChecker(InputSpacyDoc):
-        scores = TextBlob(InputSpacyDoc.text)
-        polarity = scores.sentiment.polarity
-        subjectivity = scores.sentiment.subjectivity
-        if (polarity < PolarityUpper) \
-        and (polarity > PolarityLower) \
-        and (subjectivity < SubjectivityUpper) \
-        and (subjectivity > SubjectivityLower):
-            return ReturnLabel 
-        else:
-            return ABSTAIN
+    # thresholds and labels are baked into the LF as constants
+    TextBlobSentimentChecker = labeling_function(name = LabelingFunctionName)(
+        _SpecializeFunction(_SentimentCheckerSource, 'TextBlobSentimentChecker',
+                            {'_DocSentiment': _DocSentiment},
+                            SentimentModel = SentimentModel,
+                            PolarityLower = float(PolarityLower), PolarityUpper = float(PolarityUpper),
+                            SubjectivityLower = float(SubjectivityLower), SubjectivityUpper = float(SubjectivityUpper),
+                            ReturnLabel = int(ReturnLabel), ABSTAIN = ABSTAIN))
+    
+    def BatchTextBlobSentimentChecker(InputSpacyDocs):
+        # float64 so the thresholds compare exactly as in the per-doc LF
+        scores = [_DocSentiment(each_doc, SentimentModel) for each_doc in InputSpacyDocs]
+        polarity = np.fromiter((each_score.polarity for each_score in scores), dtype = np.float64, count = len(scores))
+        subjectivity = np.fromiter((each_score.subjectivity for each_score in scores), dtype = np.float64, count = len(scores))
+        InThreshold = (polarity < PolarityUpper) & (polarity > PolarityLower) \
+                    & (subjectivity < SubjectivityUpper) & (subjectivity > SubjectivityLower)
+        return np.where(InThreshold, np.int8(ReturnLabel), np.int8(ABSTAIN))
+    
     TextBlobSentimentChecker.__name__ = LabelingFunctionName
+    TextBlobSentimentChecker.vector_apply = TextBlobSentimentChecker.batch = BatchTextBlobSentimentChecker
     
     return TextBlobSentimentChecker
 
@@ -175,6 +605,9 @@ def KeywordPresenceExactMatch(**kwargs):
     and returns LABEL if present
     if not present : ABSTAIN
     
+    Only InputSpacyDoc.text is used, so a tokenizer-only doc
+    is enough (see MakeDocForLFs)
+    
     Params:
     LabelingFunctionName:str
     ListOfKeywords:[str]
@@ -185,16 +618,22 @@ def KeywordPresenceExactMatch(**kwargs):
 
     LabelingFunctionName = kwargs['LabelingFunctionName']
     ListOfKeywords = kwargs['ListOfKeywords']
-    ReturnLabel = kwargs['ReturnLabel']
+    ReturnLabel = _CheckReturnLabel(kwargs['ReturnLabel'])
     ABSTAIN = -1
-    @labeling_function(name = LabelingFunctionName)
-    def CheckForKeywordExactMatch(InputSpacyDoc):
-        for each_keyword in ListOfKeywords:
-            if re.search('([^a-z0-9])' + each_keyword + '([^a-z0-9])', InputSpacyDoc.text.lower()) :
-                return ReturnLabel
-        return ABSTAIN
+    KeywordFound = _CompileKeywordMatcher(ListOfKeywords)
+    # labels are baked into the LF as constants
+    CheckForKeywordExactMatch = labeling_function(name = LabelingFunctionName)(
+        _SpecializeFunction(_KeywordExactMatchSource, 'CheckForKeywordExactMatch',
+                            {'KeywordFound': KeywordFound},
+                            ReturnLabel = int(ReturnLabel), ABSTAIN = ABSTAIN))
+
+    def BatchKeywordExactMatch(InputSpacyDocs):
+        Matched = np.array([KeywordFound(each_doc)
+                            for each_doc in InputSpacyDocs], dtype = bool)
+        return np.where(Matched, np.int8(ReturnLabel), np.int8(ABSTAIN))
 
     CheckForKeywordExactMatch.__name__ = LabelingFunctionName
+    CheckForKeywordExactMatch.vector_apply = CheckForKeywordExactMatch.batch = BatchKeywordExactMatch
     return CheckForKeywordExactMatch
     
     
@@ -205,6 +644,8 @@ def NamedEntityFuzzyMatch(**kwargs):
     and returns LABEL if present
     if not present : ABSTAIN
     
+    Only InputSpacyDoc.ents is used (see MakeDocForLFs)
+    
     Params:
     LabelingFunctionName:str
     ListOfKeywords:[str]
@@ -212,34 +653,92 @@ def NamedEntityFuzzyMatch(**kwargs):
     NERTag:str
     FuzzyMatchThreshold: int (value between 0 to 100)
     
+    Scores match thefuzz's fuzz.token_sort_ratio, which this LF used to
+    call: characters in the range 128-255 (e.g. accents) are dropped before
+    comparing, and the score is rounded to an integer (half to even)
+    before it is compared with FuzzyMatchThreshold.
+    
     '''
     
     
     LabelingFunctionName = kwargs['LabelingFunctionName']
     ListOfKeywords = kwargs['ListOfKeywords']
-    ReturnLabel = kwargs['ReturnLabel']
+    ReturnLabel = _CheckReturnLabel(kwargs['ReturnLabel'])
     FuzzyMatchThreshold = kwargs['FuzzyMatchThreshold']
     NERTag = kwargs['NERTag']
     ABSTAIN = -1
+    NERTagID = get_string_id(NERTag)
+    # normalized, token-sorted and deduplicated once here instead of on every document,
+    # ordered by length for the length prefilter in CandidateKeywords
+    NormalizedKeywords = sorted({_TokenSortProcess(each_name) for each_name in ListOfKeywords}, key = len)
+    KeywordLengths = np.array([len(each_name) for each_name in NormalizedKeywords])
+    
+    # thefuzz compared round(score) with the threshold, and
+    # round(score) >= FuzzyMatchThreshold needs score >= ScoreCutoff;
+    # clamped to the 0-100 range rapidfuzz accepts
+    ScoreCutoff = min(max(FuzzyMatchThreshold - 0.5, 0), 100)
+    
+    def CandidateKeywords(NamedEntities):
+        # fuzz.ratio(a, b) <= 200 * min(len(a), len(b)) / (len(a) + len(b)), so names
+        # too much shorter or longer than every entity can never reach the threshold
+        Threshold = ScoreCutoff / 100
+        if Threshold <= 0:
+            return NormalizedKeywords
+        EntityLengths = [len(each_ent) for each_ent in NamedEntities]
+        Lower = np.searchsorted(KeywordLengths, min(EntityLengths) * Threshold / (2 - Threshold) - 1, 'left')
+        Upper = np.searchsorted(KeywordLengths, max(EntityLengths) * (2 - Threshold) / Threshold + 1, 'right')
+        return NormalizedKeywords[Lower:Upper]
+    
     @labeling_function(name = LabelingFunctionName)
     def CheckForNamedEntityFuzzyMatch(InputSpacyDoc):
-        NamedEntityInDoc = ''
-        max_ratio = 0
-        for each_ent in InputSpacyDoc.ents:
-            if each_ent.label_ == NERTag:
-                NamedEntityInDoc = each_ent.text
-
-                for each_name in list(set(ListOfKeywords)):
-                    fuxzzRatio = fuzz.token_sort_ratio(str(NamedEntityInDoc).lower(), each_name.lower())
-                    if  fuxzzRatio > max_ratio:
-                        max_ratio = fuxzzRatio
-                        closest_name = each_name
-                if max_ratio >= FuzzyMatchThreshold:
-                    #print(closest_name, max_ratio)
-                    return ReturnLabel
+        if FuzzyMatchThreshold > 100:
+            # no score can reach the threshold
+            return ABSTAIN
+        # entities are matched one at a time, each against its own length window,
+        # and the search stops at the first entity with a name above the threshold
+        for each_ent in _EntsByLabel(InputSpacyDoc).get(NERTagID, ()):
+            if FuzzyMatchThreshold <= 0:
+                # every score reaches the threshold, as in the original max_ratio loop
+                return ReturnLabel
+            NamedEntityInDoc = _TokenSortProcess(each_ent)
+            closest_name = process.extractOne(NamedEntityInDoc, CandidateKeywords([NamedEntityInDoc]),
+                                              scorer = fuzz.ratio,
+                                              score_cutoff = ScoreCutoff)
+            if closest_name is not None and round(closest_name[1]) >= FuzzyMatchThreshold:
+                return ReturnLabel
         return ABSTAIN
 
+    def BatchNamedEntityFuzzyMatch(InputSpacyDocs):
+        # entities of every doc scored in one cdist call, then reduced back per doc
+        NamedEntities = []
+        DocIndex = []
+        for doc_index, each_doc in enumerate(InputSpacyDocs):
+            for each_ent in _EntsByLabel(each_doc).get(NERTagID, ()):
+                NamedEntities.append(_TokenSortProcess(each_ent))
+                DocIndex.append(doc_index)
+        labels = np.full(len(InputSpacyDocs), ABSTAIN, dtype = np.int8)
+        if not NamedEntities or FuzzyMatchThreshold > 100:
+            return labels
+        DocIndex = np.array(DocIndex)
+        if FuzzyMatchThreshold <= 0:
+            labels[DocIndex] = ReturnLabel
+            return labels
+        Candidates = CandidateKeywords(NamedEntities)
+        if not Candidates:
+            return labels
+        
+        # float64 and np.round (half to even, like round()) reproduce thefuzz's integer scores
+        scores = process.cdist(NamedEntities, Candidates,
+                               scorer = fuzz.ratio,
+                               score_cutoff = ScoreCutoff,
+                               dtype = np.float64, workers = 1).max(axis = 1)
+        DocStarts = np.flatnonzero(np.r_[True, DocIndex[1:] != DocIndex[:-1]])
+        BestScores = np.round(np.maximum.reduceat(scores, DocStarts))
+        labels[DocIndex[DocStarts][BestScores >= FuzzyMatchThreshold]] = ReturnLabel
+        return labels
+
     CheckForNamedEntityFuzzyMatch.__name__ = LabelingFunctionName
+    CheckForNamedEntityFuzzyMatch.vector_apply = CheckForNamedEntityFuzzyMatch.batch = BatchNamedEntityFuzzyMatch
     return CheckForNamedEntityFuzzyMatch
 
     
@@ -250,6 +749,9 @@ def KeywordAbsenceExactMatch(**kwargs):
     and returns LABEL if absent
     if present : ABSTAIN
     
+    Only InputSpacyDoc.text is used, so a tokenizer-only doc
+    is enough (see MakeDocForLFs)
+    
     Params:
     LabelingFunctionName:str
     ListOfKeywords:[str]
@@ -260,14 +762,127 @@ def KeywordAbsenceExactMatch(**kwargs):
     
     LabelingFunctionName = kwargs['LabelingFunctionName']
     ListOfKeywords = kwargs['ListOfKeywords']
-    ReturnLabel = kwargs['ReturnLabel']
+    ReturnLabel = _CheckReturnLabel(kwargs['ReturnLabel'])
     ABSTAIN = -1
+    KeywordFound = _CompileKeywordMatcher(ListOfKeywords)
     @labeling_function(name = LabelingFunctionName)
     def CheckForKeywordAbsenceExactMatch(InputSpacyDoc):
-        for each_keyword in ListOfKeywords:
-            if re.search('([^a-z0-9])' + each_keyword + '([^a-z0-9])', InputSpacyDoc.text.lower()) :
-                return ABSTAIN
+        if KeywordFound(InputSpacyDoc):
+            return ABSTAIN
         return ReturnLabel
 
+    def BatchKeywordAbsenceExactMatch(InputSpacyDocs):
+        Matched = np.array([KeywordFound(each_doc)
+                            for each_doc in InputSpacyDocs], dtype = bool)
+        return np.where(Matched, np.int8(ABSTAIN), np.int8(ReturnLabel))
+
     CheckForKeywordAbsenceExactMatch.__name__ = LabelingFunctionName
-    return CheckForKeywordAbsenceExactMatch
\ No newline at end of file
+    CheckForKeywordAbsenceExactMatch.vector_apply = CheckForKeywordAbsenceExactMatch.batch = BatchKeywordAbsenceExactMatch
+    return CheckForKeywordAbsenceExactMatch
+
+
+def ApplyLFs(ListOfLFs, InputSpacyDocs):
+    '''
+    Applies LFs to a list of spaCy docs and returns the label matrix
+    (num docs x num LFs), like snorkel's PandasLFApplier, but as int8
+    rather than int64, so labels must be between -1 and 127.
+    
+    LFs built by the factories in this module carry a
+    .vector_apply(InputSpacyDocs) method that labels all docs in one call
+    and returns an int8 vector, written straight into the matrix; it is
+    used when present (.batch is the same method under its older name),
+    otherwise the LF is called once per doc and its labels are checked
+    to fit int8 before they are written.
+    
+    Params:
+    ListOfLFs:[LabelingFunction]
+    InputSpacyDocs:[spacy Doc]
+    '''
+    
+    InputSpacyDocs = list(InputSpacyDocs)
+    L = np.empty((len(InputSpacyDocs), len(ListOfLFs)), dtype = np.int8)
+    for lf_index, each_lf in enumerate(ListOfLFs):
+        if hasattr(each_lf, 'vector_apply'):
+            L[:, lf_index] = each_lf.vector_apply(InputSpacyDocs)
+        else:
+            labels = np.array([each_lf(each_doc) for each_doc in InputSpacyDocs], dtype = np.int64)
+            if labels.size and (labels.min() < -1 or labels.max() > 127):
+                raise ValueError('LF %s returned labels outside -1 to 127, which do not fit '
+                                 'the int8 label matrix' % getattr(each_lf, 'name', each_lf))
+            L[:, lf_index] = labels
+    return L
+
+
+# one blank Vocab per language in each worker process, see _WorkerVocab
+_WorkerVocabs = {}
+
+
+def _WorkerVocab(lang):
+    '''
+    Returns a blank spaCy Vocab for lang, created once per process.
+    DocBin carries the strings its docs use, and the blank Vocab supplies
+    the lexical attributes (LOWER etc.), so the pipeline's full vocab and
+    vectors never have to be sent to the workers.
+    '''
+    
+    Vocab = _WorkerVocabs.get(lang)
+    if Vocab is None:
+        Vocab = _WorkerVocabs[lang] = spacy.blank(lang).vocab
+    return Vocab
+
+
+def _ApplyLFsToDocBin(ListOfLFs, DocBinBytes, lang):
+    '''
+    Worker side of ApplyLFsParallel: rebuilds the docs of one chunk from
+    DocBin bytes and labels them with ApplyLFs.
+    '''
+    
+    InputSpacyDocs = list(DocBin().from_bytes(DocBinBytes).get_docs(_WorkerVocab(lang)))
+    return ApplyLFs(ListOfLFs, InputSpacyDocs)
+
+
+def ApplyLFsParallel(ListOfLFs, InputSpacyDocs, n_jobs = -1, attrs = None, store_user_data = True):
+    '''
+    Same as ApplyLFs, but splits the docs into chunks (about 4 per worker)
+    and labels the chunks in parallel worker processes with joblib's loky
+    backend. The LFs are sent to the workers with cloudpickle, which
+    handles the closures built by the factories in this module.
+    
+    Docs are sent as DocBin bytes and rebuilt in the workers against a
+    blank Vocab of the docs' language (see _WorkerVocab); pickling the docs
+    themselves would send the whole vocab, including its vectors, with
+    every chunk. LFs that read word vectors (token.vector, similarity)
+    therefore need ApplyLFs.
+    
+    By default DocBin's own attributes (tags, POS, lemmas, dependencies,
+    sentence starts, entities, ...) and doc.user_data, which holds the
+    custom extension values, are sent, so any LF sees the same annotations
+    as under ApplyLFs. Extensions must be registered in an importable
+    module for the workers to know them. The LFs built by the factories in
+    this module only need attrs = ['ENT_IOB', 'ENT_TYPE'] and
+    store_user_data = False, which makes the chunks much smaller.
+    Values cached on the docs in the workers are not written back.
+    
+    Params:
+    ListOfLFs:[LabelingFunction]
+    InputSpacyDocs:[spacy Doc]
+    n_jobs:int -> number of worker processes, -1 for all CPUs
+    attrs:[str] (optional) -> token attributes to send, DocBin's default if None
+    store_user_data:bool -> send doc.user_data (custom extensions, cached values)
+    '''
+    
+    InputSpacyDocs = list(InputSpacyDocs)
+    NumChunks = min(len(InputSpacyDocs), effective_n_jobs(n_jobs) * 4)
+    if NumChunks <= 1:
+        return ApplyLFs(ListOfLFs, InputSpacyDocs)
+    
+    DocBinOptions = {'store_user_data': store_user_data}
+    if attrs is not None:
+        DocBinOptions['attrs'] = attrs
+    ChunkBounds = np.linspace(0, len(InputSpacyDocs), NumChunks + 1).astype(int)
+    DocBinChunks = [DocBin(docs = InputSpacyDocs[start:end], **DocBinOptions).to_bytes()
+                    for start, end in zip(ChunkBounds[:-1], ChunkBounds[1:])]
+    LChunks = Parallel(n_jobs = n_jobs, backend = 'loky')(
+        delayed(_ApplyLFsToDocBin)(ListOfLFs, each_chunk, InputSpacyDocs[0].lang_ or 'xx')
+        for each_chunk in DocBinChunks)
+    return np.vstack(LChunks)
@@ -0,0 +1,315 @@
+import random
+import re
+
+import numpy as np
+import pytest
+import spacy
+from spacy.tokens import Span
+
+import LabelingFunctionGeneratorUtils as LFUtils
+
+
+nlp = spacy.blank('en')
+
+MatcherTiers = [LFUtils._FindKeywordMatcher, LFUtils._RegexKeywordMatcher, LFUtils._FlashTextKeywordMatcher]
+
+
+def ReferenceKeywordFound(ListOfKeywords, text):
+    '''
+    The keyword rule every matcher tier must follow: a lowercased keyword
+    found in text.lower(), not touching [a-z0-9] on either side.
+    '''
+    
+    return any(re.search('(?<![a-z0-9])' + re.escape(each_keyword.lower()) + '(?![a-z0-9])', text.lower())
+               for each_keyword in ListOfKeywords)
+
+
+def TierResults(ListOfKeywords, text):
+    Keywords = sorted({each_keyword.lower() for each_keyword in ListOfKeywords}, key = len, reverse = True)
+    return [each_tier(Keywords)(nlp.make_doc(text)) for each_tier in MatcherTiers]
+
+
+@pytest.mark.parametrize('ListOfKeywords, text', [
+    (['ok'], 'kapalıok'),
+    (['ok'], 'xſok'),
+    (['ok'], 'Kok'),
+    (['x'], 'xİ'),
+    (['stanbul'], 'İstanbul'),
+    (['café'], 'CAFÉ bar'),
+    (['credit card'], 'My Credit Card.'),
+    (['ssn'], 'assn'),
+    (['c++'], 'use C++ now'),
+])
+def test_matcher_tiers_agree_on_edge_cases(ListOfKeywords, text):
+    expected = ReferenceKeywordFound(ListOfKeywords, text)
+    assert TierResults(ListOfKeywords, text) == [expected] * len(MatcherTiers)
+
+
+def test_matcher_tiers_agree_on_random_text():
+    random.seed(0)
+    vocab = ['ab', 'CD', 'aBc', 'x1', 'New', 'YORK', 'c++', 'a-b', 'y_z', '9',
+             'café', 'CAFÉ', 'İ', 'ı', 'ſ', 'K', 'ß', 'ok', 'OK']
+    separators = [' ', ' ', ',', '.', '_', '-']
+    for _ in range(3000):
+        ListOfKeywords = [' '.join(random.choice(vocab) for _ in range(random.randint(1, 2)))
+                          for _ in range(random.randint(1, 5))]
+        text = ''.join(random.choice(vocab + separators) for _ in range(random.randint(0, 12)))
+        expected = ReferenceKeywordFound(ListOfKeywords, text)
+        assert TierResults(ListOfKeywords, text) == [expected] * len(MatcherTiers), (ListOfKeywords, text)
+
+
+def test_empty_keyword_list_never_matches():
+    assert not LFUtils._CompileKeywordMatcher([])(nlp.make_doc('anything at all'))
+
+
+def MakeDocWithEnts(text, ents):
+    doc = nlp.make_doc(text)
+    doc.ents = [Span(doc, start, end, label = label) for start, end, label in ents]
+    return doc
+
+
+def test_fuzzy_match_agrees_with_thefuzz():
+    thefuzz = pytest.importorskip('thefuzz.fuzz')
+    random.seed(0)
+    syllables = ['jo', 'sé', 'bi', 'den', 'NAN', 'cy', 'pé', 'lo', 'si', 'mc', 'con', 'ÁN', 'ka',
+                 'ma', 'la', 'HAR', 'ris', 'ÿ', 'Ÿ', 'İ', 'ñ', 'ü', '.']
+    def RandomName():
+        return ' '.join(''.join(random.choice(syllables) for _ in range(random.randint(1, 3)))
+                        for _ in range(random.randint(1, 3)))
+    for _ in range(300):
+        Gazetteer = [RandomName() for _ in range(random.randint(0, 20))]
+        FuzzyMatchThreshold = random.choice([0, 0.3, 50, 67, 75, 80, 85, 90, 100, 100.3, 101, 150])
+        lf = LFUtils.NamedEntityFuzzyMatch(LabelingFunctionName = 'fuzzy', ListOfKeywords = Gazetteer,
+                                           ReturnLabel = 1, FuzzyMatchThreshold = FuzzyMatchThreshold,
+                                           NERTag = 'PERSON')
+        docs = []
+        for _ in range(5):
+            names = [RandomName() for _ in range(random.randint(0, 3))]
+            tokens = []
+            ents = []
+            for each_name in names:
+                length = len(nlp.make_doc(each_name))
+                ents.append((len(tokens), len(tokens) + length, random.choice(['PERSON', 'ORG'])))
+                tokens += [token.text for token in nlp.make_doc(each_name)] + ['and']
+            docs.append(MakeDocWithEnts(' '.join(tokens), ents))
+        for each_doc in docs:
+            # the original per-doc loop, scored with thefuzz
+            expected = -1
+            max_ratio = 0
+            for each_ent in each_doc.ents:
+                if each_ent.label_ == 'PERSON':
+                    for each_name in set(Gazetteer):
+                        max_ratio = max(max_ratio, thefuzz.token_sort_ratio(each_ent.text.lower(), each_name.lower()))
+                    if max_ratio >= FuzzyMatchThreshold:
+                        expected = 1
+                        break
+            assert lf(each_doc) == expected, (Gazetteer, each_doc.ents, FuzzyMatchThreshold)
+        assert list(lf.vector_apply(docs)) == [lf(each_doc) for each_doc in docs]
+
+
+def test_pipes_for_lfs_keeps_every_entity_source():
+    PipelineNLP = spacy.blank('en')
+    for each_factory in ['tok2vec', 'tagger', 'parser', 'attribute_ruler', 'entity_ruler', 'ner', 'textcat']:
+        PipelineNLP.add_pipe(each_factory)
+    PipelineNLP.add_pipe('span_ruler', name = 'span_ruler', config = {'annotate_ents': True})
+    PipelineNLP.add_pipe('span_ruler', name = 'spans_only')
+    PipelineNLP.add_pipe('sentencizer')
+    assert LFUtils._PipesForLFs(PipelineNLP) == ['attribute_ruler', 'entity_ruler', 'ner', 'span_ruler']
+
+
+def test_make_docs_for_lfs_keeps_ruler_entities():
+    PipelineNLP = spacy.blank('en')
+    PipelineNLP.add_pipe('sentencizer')
+    PipelineNLP.add_pipe('entity_ruler').add_patterns([{'label': 'PERSON', 'pattern': 'Joe Biden'}])
+    docs = LFUtils.MakeDocsForLFs(PipelineNLP, ['I met Joe Biden.', 'Nobody here.'])
+    assert [[(each_ent.text, each_ent.label_) for each_ent in each_doc.ents] for each_doc in docs] \
+        == [[('Joe Biden', 'PERSON')], []]
+    assert LFUtils.MakeDocForLFs(PipelineNLP, 'I met Joe Biden.').ents[0].text == 'Joe Biden'
+
+
+@pytest.mark.parametrize('ReturnLabel', [-2, 128, 1000, 1.0, True])
+def test_factories_reject_labels_outside_int8(ReturnLabel):
+    with pytest.raises(ValueError):
+        LFUtils.KeywordPresenceExactMatch(LabelingFunctionName = 'kw', ListOfKeywords = ['ssn'],
+                                          ReturnLabel = ReturnLabel)
+
+
+def test_apply_lfs_checks_labels_of_plain_lfs():
+    docs = [nlp.make_doc('call me today')]
+    
+    @LFUtils.labeling_function(name = 'too_big')
+    def TooBig(InputSpacyDoc):
+        return 200
+    
+    with pytest.raises(ValueError):
+        LFUtils.ApplyLFs([TooBig], docs)
+
+
+def test_batch_is_an_alias_of_vector_apply():
+    lf = LFUtils.KeywordPresenceExactMatch(LabelingFunctionName = 'kw', ListOfKeywords = ['today'], ReturnLabel = 127)
+    docs = [nlp.make_doc('call me today'), nlp.make_doc('call me later')]
+    assert lf.batch is lf.vector_apply
+    assert lf.batch(docs).tolist() == [127, -1]
+
+
+def MakeAnnotatedDocs(NumDocs):
+    # docs with entities, sentence starts and POS, as a full pipeline would leave them
+    random.seed(2)
+    Words = ['the', 'senator', 'said', 'credit', 'card', 'great', 'vote', 'ssn', 'today', '.']
+    docs = []
+    for _ in range(NumDocs):
+        tokens = [random.choice(Words) for _ in range(random.randint(3, 12))] + ['John', 'Smith', '.']
+        doc = nlp.make_doc(' '.join(tokens))
+        doc.ents = [Span(doc, len(tokens) - 3, len(tokens) - 1, label = random.choice(['PERSON', 'POLITICIAN']))]
+        for each_token in doc:
+            each_token.is_sent_start = each_token.i == 0 or doc[each_token.i - 1].text == '.'
+            each_token.pos_ = 'PUNCT' if each_token.text == '.' else 'NOUN'
+        docs.append(doc)
+    return docs
+
+
+@LFUtils.labeling_function(name = 'many_sents')
+def ManySents(InputSpacyDoc):
+    return 1 if len(list(InputSpacyDoc.sents)) > 2 else -1
+
+
+@LFUtils.labeling_function(name = 'many_nouns')
+def ManyNouns(InputSpacyDoc):
+    return 1 if sum(each_token.pos_ == 'NOUN' for each_token in InputSpacyDoc) > 6 else -1
+
+
+def ParallelTestLFs():
+    return [
+        LFUtils.NERTagPresence(LabelingFunctionName = 'person', NERTag = 'PERSON', ReturnLabel = 1),
+        LFUtils.NERTagAbsence(LabelingFunctionName = 'no_politician', NERTag = 'POLITICIAN', ReturnLabel = 0),
+        LFUtils.NamedEntityFuzzyMatch(LabelingFunctionName = 'smith', ListOfKeywords = ['Jon Smith'],
+                                      ReturnLabel = 1, FuzzyMatchThreshold = 85, NERTag = 'POLITICIAN'),
+        LFUtils.KeywordPresenceExactMatch(LabelingFunctionName = 'card', ListOfKeywords = ['credit card'], ReturnLabel = 1),
+        LFUtils.SentimentChecker(LabelingFunctionName = 'great', SubjectivityLower = 0.0, SubjectivityUpper = 1.0,
+                                 PolarityLower = 0.0, PolarityUpper = 1.0, ReturnLabel = 1),
+        ManySents,
+        ManyNouns,
+    ]
+
+
+def test_apply_lfs_parallel_matches_apply_lfs():
+    docs = MakeAnnotatedDocs(40)
+    L = LFUtils.ApplyLFs(ParallelTestLFs(), docs)
+    assert len(set(L[:, 5].tolist())) == 2 and len(set(L[:, 6].tolist())) == 2
+    assert (LFUtils.ApplyLFsParallel(ParallelTestLFs(), docs, n_jobs = 2) == L).all()
+    # the factory LFs alone only need the entities
+    LFactory = LFUtils.ApplyLFsParallel(ParallelTestLFs()[:5], MakeAnnotatedDocs(40), n_jobs = 2,
+                                        attrs = ['ENT_IOB', 'ENT_TYPE'], store_user_data = False)
+    assert (LFactory == L[:, :5]).all()
+
+
+def test_ner_lfs_see_entities_set_after_first_use():
+    doc = nlp.make_doc('John Smith called today')
+    lfs = [LFUtils.NERTagPresence(LabelingFunctionName = 'person', NERTag = 'PERSON', ReturnLabel = 1),
+           LFUtils.NERTagAbsence(LabelingFunctionName = 'no_person', NERTag = 'PERSON', ReturnLabel = 0),
+           LFUtils.NamedEntityFuzzyMatch(LabelingFunctionName = 'smith', ListOfKeywords = ['John Smith'],
+                                         ReturnLabel = 1, FuzzyMatchThreshold = 90, NERTag = 'PERSON')]
+    assert [each_lf(doc) for each_lf in lfs] == [-1, 0, -1]
+    doc.ents = [Span(doc, 0, 2, label = 'PERSON')]
+    assert [each_lf(doc) for each_lf in lfs] == [1, -1, 1]
+    assert LFUtils.ApplyLFs(lfs, [doc]).tolist() == [[1, -1, 1]]
+    doc.ents = [Span(doc, 0, 2, label = 'ORG')]
+    assert [each_lf(doc) for each_lf in lfs] == [-1, 0, -1]
+
+
+def ReferenceLexiconSentiment(InputSpacyDoc):
+    '''
+    The 'Lexicon' sentiment model as a plain dict lookup: the mean TextBlob
+    lexicon scores of the lowercased tokens found in the lexicon.
+    '''
+    
+    Lexicon = {each_word: each_scores[None] for each_word, each_scores in LFUtils.TextBlobLexicon.items()
+               if ' ' not in each_word and each_word == each_word.lower()}
+    scores = [Lexicon[each_token.lower_] for each_token in InputSpacyDoc if each_token.lower_ in Lexicon]
+    if not scores:
+        return 0.0, 0.0
+    return (sum(each_score[0] for each_score in scores) / len(scores),
+            sum(each_score[1] for each_score in scores) / len(scores))
+
+
+def RandomSentimentDocs(NumDocs):
+    random.seed(3)
+    LexiconWords = sorted(each_word for each_word in LFUtils.TextBlobLexicon.keys() if ' ' not in each_word)
+    OtherWords = ['senator', 'vote', 'ssn', 'the', 'not', 'very', '!', '.', 'café', 'Ñandú', '123']
+    docs = []
+    for _ in range(NumDocs):
+        words = [random.choice(LexiconWords) if random.random() < 0.5 else random.choice(OtherWords)
+                 for _ in range(random.randint(0, 15))]
+        words = [each_word.upper() if random.random() < 0.1 else each_word for each_word in words]
+        docs.append(nlp.make_doc(' '.join(words)))
+    return docs
+
+
+def test_lexicon_sentiment_agrees_with_dict_lookup():
+    docs = RandomSentimentDocs(300)
+    LexiconArrays = LFUtils._GetLexiconArrays()
+    # the numba-compiled kernel and, when numba is installed, the plain NumPy one behind it
+    Kernels = [LFUtils._MeanLexiconSentiment, getattr(LFUtils._MeanLexiconSentiment, 'py_func', None)]
+    for each_doc in docs:
+        expected = ReferenceLexiconSentiment(each_doc)
+        assert LFUtils._LexiconSentiment(each_doc) == pytest.approx(expected, rel = 1e-12, abs = 1e-15)
+        TokenIDs = each_doc.to_array('LOWER').astype(np.uint64)
+        for each_kernel in filter(None, Kernels):
+            assert each_kernel(TokenIDs, *LexiconArrays) == pytest.approx(expected, rel = 1e-12, abs = 1e-15)
+
+
+def test_doc_sentiment_is_cached_per_model():
+    doc = nlp.make_doc('What a great and wonderful day, not bad at all')
+    scores = LFUtils._DocSentiment(doc, 'TextBlob')
+    assert tuple(scores) == tuple(LFUtils.TextBlob(doc.text).sentiment)
+    assert LFUtils._DocSentiment(doc, 'TextBlob') is scores
+    LexiconScores = LFUtils._DocSentiment(doc, 'Lexicon')
+    assert tuple(LexiconScores) == pytest.approx(ReferenceLexiconSentiment(doc))
+    assert LFUtils._DocSentiment(doc, 'Lexicon') is LexiconScores
+    assert LFUtils._DocSentiment(doc, 'TextBlob') is scores
+    with pytest.raises(ValueError):
+        LFUtils._DocSentiment(doc, 'VADER')
+
+
+@pytest.mark.parametrize('SentimentModel', ['TextBlob', 'Lexicon'])
+def test_sentiment_checker_agrees_with_original_comparison(SentimentModel):
+    docs = RandomSentimentDocs(150)
+    if SentimentModel == 'TextBlob':
+        Reference = [tuple(LFUtils.TextBlob(each_doc.text).sentiment) for each_doc in docs]
+    else:
+        Reference = [ReferenceLexiconSentiment(each_doc) for each_doc in docs]
+    ScoreValues = sorted({each_value for each_score in Reference for each_value in each_score})
+    # infinite, NumPy scalar and exact score values, the last ones to check that bounds are exclusive
+    Bounds = [-np.inf, np.inf, 0, 1, -1, np.float64(0.25), np.float32(0.5), np.int64(0), -0.1, 0.1]
+    random.seed(4)
+    for _ in range(40):
+        PolarityLower, PolarityUpper, SubjectivityLower, SubjectivityUpper = [
+            random.choice(Bounds + ScoreValues) for _ in range(4)]
+        ReturnLabel = random.choice([0, 1, np.int64(2), 127])
+        lf = LFUtils.SentimentChecker(LabelingFunctionName = 'sentiment', SentimentModel = SentimentModel,
+                                      PolarityLower = PolarityLower, PolarityUpper = PolarityUpper,
+                                      SubjectivityLower = SubjectivityLower, SubjectivityUpper = SubjectivityUpper,
+                                      ReturnLabel = ReturnLabel)
+        # the original LF's comparison, with the thresholds read as Python floats
+        expected = [ReturnLabel if float(PolarityLower) < polarity < float(PolarityUpper)
+                    and float(SubjectivityLower) < subjectivity < float(SubjectivityUpper) else -1
+                    for polarity, subjectivity in Reference]
+        assert [lf(each_doc) for each_doc in docs] == expected
+        assert lf.vector_apply(docs).tolist() == expected
+
+
+@pytest.mark.parametrize('NERTag', ['PERSON', 'POLITICIAN_XYZ'])
+def test_ner_lfs_match_builtin_and_custom_labels(NERTag):
+    # PERSON is a spaCy symbol (a small integer ID), the custom label is a string hash
+    doc = nlp.make_doc('John Smith called Jane Doe')
+    doc.ents = [Span(doc, 0, 2, label = NERTag), Span(doc, 3, 5, label = 'ORG')]
+    assert doc.ents[0].label == LFUtils.get_string_id(NERTag)
+    lfs = [LFUtils.NERTagPresence(LabelingFunctionName = 'present', NERTag = NERTag, ReturnLabel = 1),
+           LFUtils.NERTagAbsence(LabelingFunctionName = 'absent', NERTag = NERTag, ReturnLabel = 0),
+           LFUtils.NamedEntityFuzzyMatch(LabelingFunctionName = 'fuzzy', ListOfKeywords = ['Smith John'],
+                                         ReturnLabel = 1, FuzzyMatchThreshold = 100, NERTag = NERTag)]
+    OtherDoc = nlp.make_doc('Jane Doe called')
+    OtherDoc.ents = [Span(OtherDoc, 0, 2, label = 'ORG')]
+    assert [each_lf(doc) for each_lf in lfs] == [1, -1, 1]
+    assert [each_lf(OtherDoc) for each_lf in lfs] == [-1, 0, -1]
+    assert LFUtils.ApplyLFs(lfs, [doc, OtherDoc]).tolist() == [[1, -1, 1], [-1, 0, -1]]